@@ -6,7 +6,6 @@ from .classification import strategy_comparison
 import preprocessing_profiling.html as html
 from .base import infer_missing_entries
 from .plot import generate_report_visualizations
-from IPython.display import display
 from time import sleep
 
 DEFAULT_OUTPUTFILE = "report.html"
@@ -15,7 +14,7 @@ class ProfileReport(object):
 	html = ''
 	file = None
 	
-	def __init__(self, df, format_missing_values = True, model="DecisionTreeClassifier"):
+	def __init__(self, df, format_missing_values = True, model="DecisionTreeClassifier", processes = 1):
 		if not isinstance(df, pd.DataFrame):
 			raise TypeError("df must be of type pandas.DataFrame")
 		if df.empty:
@@ -28,7 +27,7 @@ class ProfileReport(object):
 			report = strategy_comparison(df, model)
 		messages = set(map(lambda warning: warning.message.__str__(), w))
 		
-		report = generate_report_visualizations(report)
+		report = generate_report_visualizations(report, processes)
 		
 		self.html = html.report(report, messages)
 		
@@ -82,6 +81,8 @@ class ProfileReport(object):
 			The HTML internal representation.
 		"""
 		
+		from IPython.display import display
+		
 		class Importer:
 			def __init__(self):
 				self.html = html.importer()
@@ -6,15 +6,6 @@ import random
 from sklearn.impute import SimpleImputer
 from sklearn.metrics import classification_report, accuracy_score
 from sklearn.model_selection import train_test_split
-from sklearn.neural_network import MLPClassifier
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import SVC
-from sklearn.gaussian_process import GaussianProcessClassifier
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
-from sklearn.naive_bayes import GaussianNB
-from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
-from sklearn.dummy import DummyClassifier
 from preprocessing_profiling.base import generate_missing_values, clear_cache, has_bool
 
 def model_report(df, model):
@@ -107,25 +98,36 @@ def strategy_comparison(df, model):
 	strategy_count = 0
 	
 	if(type(model) == str):
+		# The estimators are imported only when requested, since loading all of them is slow
 		if(model == "DecisionTreeClassifier"):
+			from sklearn.tree import DecisionTreeClassifier
 			model = DecisionTreeClassifier()
 		elif(model == "DummyClassifier"):
+			from sklearn.dummy import DummyClassifier
 			model = DummyClassifier()
 		elif(model == "MLPClassifier"):
+			from sklearn.neural_network import MLPClassifier
 			model = MLPClassifier()
 		elif(model == "KNeighborsClassifier"):
+			from sklearn.neighbors import KNeighborsClassifier
 			model = KNeighborsClassifier()
 		elif(model == "SVC"):
+			from sklearn.svm import SVC
 			model = SVC()
 		elif(model == "GaussianProcessClassifier"):
+			from sklearn.gaussian_process import GaussianProcessClassifier
 			model = GaussianProcessClassifier()
 		elif(model == "AdaBoostClassifier"):
+			from sklearn.ensemble import AdaBoostClassifier
 			model = AdaBoostClassifier()
 		elif(model == "RandomForestClassifier"):
+			from sklearn.ensemble import RandomForestClassifier
 			model = RandomForestClassifier()
 		elif(model == "GaussianNB"):
+			from sklearn.naive_bayes import GaussianNB
 			model = GaussianNB()
 		elif(model == "QuadraticDiscriminantAnalysis"):
+			from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
 			model = QuadraticDiscriminantAnalysis()
 		else:
 			raise Exception("\""+ model +"\" is not a valid model name. Please check the documentation for a list of valid names or directly use a scikit-learn classifier instead.")
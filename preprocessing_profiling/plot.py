@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 """Plot distribution of datasets"""
 import base64
-from distutils.version import LooseVersion
+import hashlib
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import preprocessing_profiling.base as base
-from pkg_resources import resource_filename
 import matplotlib
 from matplotlib import gridspec
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Patch
 from matplotlib import cm
-from matplotlib.colors import ListedColormap
 import numpy as np
 import pandas as pd
+from PIL import Image
 import warnings
 
 BACKEND = matplotlib.get_backend()
@@ -18,34 +24,133 @@ if matplotlib.get_backend().lower() != BACKEND.lower():
 	# If backend is not set properly a call to describe will hang
 	matplotlib.use(BACKEND)
 from matplotlib import pyplot as plt
+from io import BytesIO
+
+# Colormap used to tell the prediction errors apart, looked up once instead of on every matrix. It's a LinearSegmentedColormap, so its lookup table is only computed when it's first used.
 try:
-	from StringIO import BytesIO
-except ImportError:
-	from io import BytesIO
-try:
-	from urllib import quote
-except ImportError:
-	from urllib.parse import quote
+	_PREDICTION_CMAP = matplotlib.colormaps["rainbow"]
+except AttributeError:
+	# matplotlib.colormaps doesn't exist before matplotlib 3.5
+	_PREDICTION_CMAP = cm.get_cmap("rainbow")
+
+_FIGURE_POOL = threading.local() # Each thread has its own pool, so threads never clear each other's figures
+
+def _acquire_figure(figsize):
+	"""Get an empty figure of the given size.
+	
+	Figures are kept in a per-thread pool by size and cleared before being
+	handed out again, which is cheaper than creating a new figure for every
+	plot. A figure is only valid until the next call with the same size in
+	the same thread.
+	
+	Parameters
+	----------
+	figsize: tuple
+		The size of the figure in inches.
+	
+	Returns
+	-------
+	Figure
+		The figure, attached to an Agg canvas.
+	"""
+	if not hasattr(_FIGURE_POOL, 'figures'):
+		_FIGURE_POOL.figures = {}
+	fig = _FIGURE_POOL.figures.get(figsize)
+	if fig is None:
+		fig = Figure(figsize=figsize)
+		FigureCanvasAgg(fig)
+		_FIGURE_POOL.figures[figsize] = fig
+	else:
+		fig.clf()
+	return fig
+
+def _png_bytes_to_data_uri(buf):
+	"""Encode PNG bytes as a base64 data URI.
+	
+	Base64 output only uses characters that are valid in a data URI, so it is
+	embedded as is instead of being percent-encoded.
+	
+	The URI is returned as a str because the templates embed it directly. An
+	ASCII-only str takes one byte per character, so this costs no more
+	memory than keeping it as bytes.
+	
+	Parameters
+	----------
+	buf: bytes-like object
+		The PNG image.
+	
+	Returns
+	-------
+	str
+		The data URI.
+	"""
+	return (b'data:image/png;base64,' + base64.b64encode(buf)).decode('ascii')
+
+def _pack_rgb(rgb):
+	# Pack the RGB channels of the last axis into a single integer per color
+	
+	rgb = rgb.astype(np.uint32)
+	return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+def _save_png_fast(fig, imgdata):
+	"""Save a figure as a PNG using the fastest zlib compression level.
+	
+	Level 1 produces slightly bigger files than matplotlib's default level 6
+	but takes a fraction of the time to encode. Figures with at most 256
+	colors, such as most missing matrixes, are saved as 8-bit palette images,
+	which store a quarter of the bytes per pixel. Other figures are saved as
+	RGB. Both are lossless.
+	
+	Parameters
+	----------
+	fig: Figure
+		The figure to save.
+	imgdata: BytesIO
+		The buffer the image is written to.
+	"""
+	fig.canvas.draw()
+	rgb = np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[..., :3])
+	image = Image.fromarray(rgb)
+	colors = image.getcolors(256) # None if there are more than 256 colors
+	if colors is not None:
+		# Map every pixel to the index of its exact color in the palette
+		palette_colors = np.array([color for count, color in colors], dtype=np.uint8)
+		palette_keys = _pack_rgb(palette_colors)
+		palette_order = np.argsort(palette_keys)
+		indexes = palette_order[np.searchsorted(palette_keys[palette_order], _pack_rgb(rgb))].astype(np.uint8)
+		image = Image.fromarray(indexes, 'P')
+		image.putpalette(palette_colors.tobytes())
+	image.save(imgdata, 'PNG', compress_level=1)
 
-def missing_matrix(df, predictions = False):
+def missing_matrix(df, predictions = None, orders = None, classes = None):
 	"""Plot a missingno matrix
 	
 	Parameters
 	----------
 	df: DataFrame
 		The dataframe.
+	predictions: array, optional
+		The predicted class of each row. When given, the last column of df
+		holds the actual classes and the prediction errors are color coded.
+	orders: list, optional
+		Row orders (arrays of row positions) to also plot the matrix with. The
+		figure is only drawn once, each order just rearranges its rows.
+	classes: array, optional
+		The sorted classes of the actual column, when predictions are given.
+		Computed from df if not given.
 	
 	Returns
 	-------
-	str
-		The resulting image encoded as a string.
+	str or list
+		The resulting image encoded as a string. If orders is given, a list
+		with the image of the original order followed by one for each order.
 	"""
 	
 	def matrix(df,
 			   filter=None, n=0, p=0, sort=None,
 			   figsize=(25, 10), width_ratios=(15, 1), color=(0.25, 0.25, 0.25),
 			   fontsize=16, labels=None, sparkline=True, inline=False,
-			   freq=None, ax=None, predictions=False):
+			   freq=None, ax=None, predictions=None, classes=None):
 		"""
 		A matrix visualization of the nullity of the given DataFrame.
 		
@@ -62,24 +167,26 @@ def missing_matrix(df, predictions = False):
 		:param width_ratios: The ratio of the width of the matrix to the width of the sparkline. Defaults to `(15, 1)`.
 		Does nothing if `sparkline=False`.
 		:param color: The color of the filled columns. Default is `(0.25, 0.25, 0.25)`.
+		:param predictions: The predicted class of each row, compared with the actual classes in the last column. Defaults to None.
+		:param classes: The sorted classes of the actual column when plotting predictions. Computed from the data by default.
 		:return: If `inline` is False, the underlying `matplotlib.figure` object. Else, nothing.
 		"""
 		df = base.nullity_filter(df, filter=filter, n=n, p=p)
 		df = base.nullity_sort(df, sort=sort, axis='columns')
 		
-		if(predictions):
-			predicted = df[df.columns[-1]]
-			actual = df[df.columns[-2]]
-			df = df.drop(columns = df.columns[-1])
-			classes = actual.unique()
-			classes.sort()
+		if predictions is not None:
+			predicted = np.asarray(predictions)
+			actual = df[df.columns[-1]]
+			if classes is None:
+				classes = actual.unique()
+				classes.sort()
 			combinations = []
 			colorNumber = 0
 			for classA in classes:
 				for classB in classes:
 					combinations.append((classA, classB))
 					colorNumber += 1
-			colors = cm.get_cmap("rainbow")(np.linspace(0, 1, colorNumber))
+			colors = _PREDICTION_CMAP(np.linspace(0, 1, colorNumber))
 		height = df.shape[0]
 		width = df.shape[1]
 		
@@ -88,7 +195,7 @@ def missing_matrix(df, predictions = False):
 		g = np.zeros((height, width, 3))
 		
 		g[z0 < 0.5] = [1, 1, 1]
-		if(predictions):
+		if predictions is not None:
 			legend_elements = []
 			j = 0
 			for combination in combinations:
@@ -97,10 +204,8 @@ def missing_matrix(df, predictions = False):
 					color1 = color
 				else:
 					color1 = colors[j][0:3]
-				z1 = z0.copy()
-				for i in range(0, height):
-					if not(actual.iloc[i] == combination[0] and predicted.iloc[i] == combination[1]):
-						z1[i] = np.zeros(width, dtype=bool)
+				# Keep only the valid entries of the rows with this actual-predicted combination
+				z1 = z0 & ((actual.values == combination[0]) & (predicted == combination[1]))[:, np.newaxis]
 				g[z1 > 0.5] = color1
 				if np.any(z1) and combination[0] != combination[1]:
 					legend_elements.append(Patch(facecolor = color1, edgecolor = 'black', label = "Class " + str(combination[0]) + " → " + "Class " + str(combination[1])))
@@ -109,14 +214,15 @@ def missing_matrix(df, predictions = False):
 		
 		# Set up the matplotlib grid layout. A unary subplot if no sparkline, a left-right splot if yes sparkline.
 		if ax is None:
-			plt.figure(figsize=figsize)
+			# The figure is created without pyplot, so it isn't tracked by pyplot's figure manager and doesn't need to be closed
+			fig = _acquire_figure(figsize)
 			if sparkline:
 				gs = gridspec.GridSpec(1, 2, width_ratios=width_ratios)
 				gs.update(wspace=0.08)
-				ax1 = plt.subplot(gs[1])
+				ax1 = fig.add_subplot(gs[1])
 			else:
 				gs = gridspec.GridSpec(1, 1)
-			ax0 = plt.subplot(gs[0])
+			ax0 = fig.add_subplot(gs[0])
 		else:
 			if sparkline is not False:
 				warnings.warn(
@@ -127,7 +233,7 @@ def missing_matrix(df, predictions = False):
 			ax0 = ax
 		
 		# Create the nullity plot.
-		ax0.imshow(g, interpolation='none')
+		image = ax0.imshow(g, interpolation='none')
 		
 		# Remove extraneous default visual elements.
 		ax0.set_aspect('auto')
@@ -214,7 +320,7 @@ def missing_matrix(df, predictions = False):
 			ax1.set_ymargin(0)
 			
 			# Plot sparkline---plot is sideways so the x and y axis are reversed.
-			ax1.plot(y_range, x_domain, color=color)
+			sparkline_line, = ax1.plot(y_range, x_domain, color=color)
 			
 			if labels:
 				# Figure out what case to display the label in: mixed, upper, lower.
@@ -235,13 +341,13 @@ def missing_matrix(df, predictions = False):
 				ax1.set_yticks([])
 			
 			# Add maximum and minimum labels, circles.
-			ax1.annotate(max_completeness,
+			max_annotation = ax1.annotate(max_completeness,
 						 xy=(max_completeness, max_completeness_index),
 						 xytext=(max_completeness + 2, max_completeness_index),
 						 fontsize=int(fontsize / 16 * 14),
 						 va='center',
 						 ha='left')
-			ax1.annotate(min_completeness,
+			min_annotation = ax1.annotate(min_completeness,
 						 xy=(min_completeness, min_completeness_index),
 						 xytext=(min_completeness - 2, min_completeness_index),
 						 fontsize=int(fontsize / 16 * 14),
@@ -249,13 +355,13 @@ def missing_matrix(df, predictions = False):
 						 ha='right')
 			
 			ax1.set_xlim([min_completeness - 2, max_completeness + 2])  # Otherwise the circles are cut off.
-			ax1.plot([min_completeness], [min_completeness_index], '.', color=color, markersize=10.0)
-			ax1.plot([max_completeness], [max_completeness_index], '.', color=color, markersize=10.0)
+			min_marker, = ax1.plot([min_completeness], [min_completeness_index], '.', color=color, markersize=10.0)
+			max_marker, = ax1.plot([max_completeness], [max_completeness_index], '.', color=color, markersize=10.0)
 		
 			# Remove tick mark (only works after plotting).
 			ax1.xaxis.set_ticks_position('none')
 		
-		if(predictions):
+		if predictions is not None:
 			box = ax0.get_position()
 			ax0.set_position([box.x0, box.y0 + box.height * 0.1, box.width, box.height * 0.9])
 			box = ax1.get_position()
@@ -271,21 +377,69 @@ def missing_matrix(df, predictions = False):
 			)
 			plt.show()
 		else:
-			return ax0
+			def reorder(order):
+				# Rearrange the rows of the plot in the given order, without drawing it again
+				image.set_data(g[order])
+				if sparkline:
+					y_range = list(reversed(completeness_srs.values[order]))
+					min_completeness_index = y_range.index(min_completeness)
+					max_completeness_index = y_range.index(max_completeness)
+					sparkline_line.set_data(y_range, x_domain)
+					max_annotation.xy = (max_completeness, max_completeness_index)
+					max_annotation.set_position((max_completeness + 2, max_completeness_index))
+					min_annotation.xy = (min_completeness, min_completeness_index)
+					min_annotation.set_position((min_completeness - 2, min_completeness_index))
+					min_marker.set_data([min_completeness], [min_completeness_index])
+					max_marker.set_data([max_completeness], [max_completeness_index])
+			
+			return ax0, reorder
 	
-	imgdata = BytesIO()
-	if(predictions):
-		plot = matrix(df, predictions = True)
-	else:
-		plot = matrix(df)
-	plot.figure.savefig(imgdata)
-	imgdata.seek(0)
-	result_string = 'data:image/png;base64,' + quote(base64.b64encode(imgdata.getvalue()))
-	plt.close(plot.figure)
-	return result_string
+	def render(plot):
+		imgdata = BytesIO()
+		_save_png_fast(plot.figure, imgdata)
+		return _png_bytes_to_data_uri(imgdata.getbuffer()) # getbuffer is a view of the image, unlike getvalue it doesn't copy it
+	
+	plot, reorder = matrix(df, predictions = predictions, classes = classes)
+	result_string = render(plot)
+	if orders is None:
+		return result_string
+	
+	images = [result_string]
+	for order in orders:
+		reorder(order)
+		images.append(render(plot))
+	return images
 
-def generate_report_visualizations(report):
-	# Receives a report and returns it with all the matplotlib based visualizations
+def _prediction_matrixes(df, predictions, orders, classes):
+	# Plot the missing matrix with the prediction errors of df in its original order and in each of the given orders
+	
+	return missing_matrix(df, predictions = predictions, orders = orders, classes = classes)
+
+def _frame_key(df, base = b''):
+	"""Fingerprint the content of a dataframe.
+	
+	Parameters
+	----------
+	df: DataFrame
+		The dataframe.
+	base: bytes
+		The fingerprint of other data to combine with, e.g. of the columns
+		df is attached to.
+	
+	Returns
+	-------
+	bytes
+		A digest of the column names and values, equal for dataframes that
+		produce the same missing matrix.
+	"""
+	key = hashlib.blake2b(digest_size=16)
+	key.update(base)
+	key.update(repr(list(df.columns)).encode('utf-8'))
+	key.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+	return key.digest()
+
+def _use_report_style():
+	# Apply the report's matplotlib style
 	
 	try:
 		# reset matplotlib style before use
@@ -293,21 +447,71 @@ def generate_report_visualizations(report):
 		matplotlib.style.use("default")
 	except:
 		pass
-	matplotlib.style.use(resource_filename(__name__, "preprocessing_profiling.mplstyle"))
+	matplotlib.style.use(os.path.join(os.path.dirname(__file__), "preprocessing_profiling.mplstyle"))
+
+def _init_worker():
+	# Prepare a worker process to render the report's images
 	
-	report['missing_matrix'] = missing_matrix(report['dataframe']['modified'])
+	matplotlib.use('Agg')
+	_use_report_style()
+
+def generate_report_visualizations(report, processes = 1):
+	# Receives a report and returns it with all the matplotlib based visualizations. With more than one process, the images are rendered in parallel.
 	
 	# Generate the missing matrixes with the color coded prediction errors. For each strategy, a matrixes will be generated for the different ways to order the rows.
+	pending = [] # The matrixes of every strategy that still need their images, along with the fingerprint, the predictions to plot and the row order of each matrix after the first
+	# The test dataframe is shared by every strategy, each one only adds its predictions. Fingerprint it once; each strategy only hashes its predictions.
+	test = report['dataframe']['test']
+	test_key = _frame_key(test)
+	actual = test.iloc[:, -1].values
+	classes = test.iloc[:, -1].unique() # The actual classes are also the same for every strategy, so they are only sorted once
+	classes.sort()
 	for strategy in report['strategy_classifications']:
-		df = report['dataframe']['test'].copy()
-		df['pred'] = report['strategy_classifications'][strategy]['result']['pred']
-		report['strategy_classifications'][strategy]['prediction_matrixes'] = [{"name": "Original Dataset", "image": missing_matrix(df, predictions = True), "quantity": np.count_nonzero(df.iloc[:, -1] != df.iloc[:, -2]), "total": df.shape[0]}]
-		combinations = np.array(df[df.iloc[:, -1] != df.iloc[:, -2]].iloc[:, -2:].drop_duplicates()) # Select every distinct combination in the last two columns where they are not the same(the result is a list with every distinct actual-predicted pair that represents a wrong prediction)
-		for pair in combinations:
-			matrix = {"name": str(pair[0])+"→"+str(pair[1])}
-			matrix['image'] = missing_matrix(df[(df.iloc[:, -2] == pair[0]) & (df.iloc[:, -1] == pair[-1])].append(df[~((df.iloc[:, -2] == pair[0]) & (df.iloc[:, -1] == pair[-1]))]), predictions = True) # Order the list with the prediction error in question on the top and generate the matrix
-			matrix['quantity'] = df[(df.iloc[:, -2] == pair[0]) & (df.iloc[:, -1] == pair[-1])].shape[0]
-			matrix['total'] = df.shape[0]
-			report['strategy_classifications'][strategy]['prediction_matrixes'].append(matrix)
+		predicted = report['strategy_classifications'][strategy]['result']['pred'].values
+		wrong = actual != predicted
+		matrixes = [{"name": "Original Dataset", "quantity": int(np.count_nonzero(wrong)), "total": test.shape[0]}]
+		orders = []
+		report['strategy_classifications'][strategy]['prediction_matrixes'] = matrixes
+		pending.append((matrixes, _frame_key(pd.DataFrame({'pred': predicted}), test_key), predicted, orders))
+		# Select every distinct actual-predicted pair that represents a wrong prediction, in the order they first appear. Each pair is packed into a single integer so NumPy can find the distinct ones.
+		actual_codes, actual_classes = pd.factorize(actual)
+		predicted_codes, predicted_classes = pd.factorize(predicted)
+		packed = actual_codes.astype(np.int64) * len(predicted_classes) + predicted_codes
+		first = np.flatnonzero(wrong)[np.sort(np.unique(packed[wrong], return_index=True)[1])] # The first row of each of those pairs
+		for row in first:
+			matrix = {"name": str(actual[row])+"→"+str(predicted[row])}
+			mask = packed == packed[row] # The rows with this pair, found with a single comparison of the packed pairs
+			orders.append(np.argsort(~mask, kind='stable')) # Order the list with the prediction error in question on the top, keeping the original order otherwise
+			matrix['quantity'] = int(np.count_nonzero(mask)) # A plain int, since the template embeds the repr of the matrixes in JavaScript
+			matrix['total'] = test.shape[0]
+			matrixes.append(matrix)
+	
+	# Strategies that make the same predictions produce identical matrixes, so they are rendered only once
+	frames = {}
+	for matrixes, key, predicted, orders in pending:
+		frames.setdefault(key, (test, predicted, orders, classes))
+	
+	tasks = list(frames.values())
+	results = None
+	# Starting the workers costs more than rendering a few matrixes, so a pool is only used when there are several to render and more than one CPU
+	if min(processes, os.cpu_count() or 1) > 1 and len(tasks) > 1:
+		try:
+			# Workers are spawned rather than forked, since forking a process that already uses matplotlib can deadlock
+			with ProcessPoolExecutor(max_workers=min(processes, len(tasks) + 1), mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker) as executor:
+				missing_matrix_future = executor.submit(missing_matrix, report['dataframe']['modified'])
+				results = list(executor.map(_prediction_matrixes, *zip(*tasks)))
+				report['missing_matrix'] = missing_matrix_future.result()
+		except BrokenProcessPool:
+			# The workers couldn't start, e.g. because the calling script isn't guarded by if __name__ == '__main__'. Each of them has already re-run the script and printed its traceback by now.
+			results = None
+	if results is None:
+		_use_report_style()
+		report['missing_matrix'] = missing_matrix(report['dataframe']['modified'])
+		results = [_prediction_matrixes(*task) for task in tasks]
+	
+	images = dict(zip(frames, results))
+	for matrixes, key, predicted, orders in pending:
+		for matrix, image in zip(matrixes, images[key]):
+			matrix['image'] = image
 	
 	return report
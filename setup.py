@@ -14,11 +14,13 @@ setup(
 	install_requires=[
 		"pandas>=0.19",
 		"matplotlib>=1.4",
+		"Pillow",
 		"jinja2>=2.8",
 		"scikit-learn>=0.21.3",
 		"numpy>=1.15.4"
 	],
 	include_package_data = True,
+	python_requires='>=3.7',
 	classifiers=[
 		'Development Status :: 5 - Production/Stable',
 		'Topic :: Software Development :: Build Tools',
@@ -29,12 +31,10 @@ setup(
 		'Intended Audience :: Developers',
 		'Topic :: Scientific/Engineering',
 		'Framework :: IPython',
-		'Programming Language :: Python :: 2',
-		'Programming Language :: Python :: 2.7',
 		'Programming Language :: Python :: 3',
-		'Programming Language :: Python :: 3.4',
-		'Programming Language :: Python :: 3.5',
-		'Programming Language :: Python :: 3.6'
+		'Programming Language :: Python :: 3.7',
+		'Programming Language :: Python :: 3.8',
+		'Programming Language :: Python :: 3.9'
 	],
 	keywords='pandas data-science data-analysis python jupyter ipython',
 )